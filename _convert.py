@@ -1,23 +1,31 @@
 """CAN serialization engine compatible with KCD."""
 
-import math
+from typing import (
+    Any, Union, List, Tuple, Dict, Callable, TypeVar, Iterable, Optional,
+    Set, TextIO,
+)
 
-from typing import Any, Union, List, Tuple, Dict, Callable, TypeVar, Iterable
-from _xml import XML
+# Types that are always in scope and never need a struct definition,
+# along with their sizes in bits.
+_BUILT_IN_SIZES: Dict[str, int] = {'bool': 1}
+_BUILT_IN_TYPES = frozenset(_BUILT_IN_SIZES)
 
+# One direct member of a struct, as laid out on the wire: its field
+# name, size in bits, kind (one of 'signal', 'bool', 'nested' or
+# 'enum'), and either its CANSignal or the name of its type.
+_LayoutEntry = Tuple[str, int, str, Union['CANSignal', str]]
 
-class KCDMessageSerializer:
-    """Class to serialize a KCD file, and keep track of bit offset."""
+# Signals already loaded from one database, keyed by their parameters;
+# see `CANSignal.get_or_create()`.
+_SignalTable = Dict[str, 'CANSignal']
 
-    def __init__(self) -> None:
-        """Initialize."""
-        self.bit_pos = 0
-        self.contents: List[XML] = []
+# Text forms of every bit offset that fits in a single frame.
+_BITPOS_STRS = [str(i) for i in range(65)]
 
-    def write(self, xml: XML, size: int) -> None:
-        """Write a new XML node to the KCD, and advance the bit position."""
-        self.contents.append(xml)
-        self.bit_pos += size
+
+def _bit_pos_str(bit_pos: int) -> str:
+    """Get the text form of a bit offset."""
+    return _BITPOS_STRS[bit_pos] if bit_pos < 65 else str(bit_pos)
 
 
 class CANSemanticException(Exception):
@@ -29,45 +37,70 @@ class CANSignal:
 
     def __init__(self, params: Any) -> None:
         """Load from YAML."""
-        self.unit = params['unit'] if 'unit' in params else ''
+        self.unit = params.get('unit', '')
         self.min: int = params['range'][0]
         self.max: int = params['range'][1]
-        self.size: int = params['size'] if 'size' in params else 8
+        self.size: int = params.get('size', 8)
 
-    def slope(self) -> float:
-        """Slope of the linear equation."""
+        # The slope gets emitted on nearly every generated line that
+        # touches this signal, so compute it and its text form once.
         input_range: float = 2 ** self.size - 1
         output_range = self.max - self.min
-        return output_range / input_range
+        self._slope = output_range / input_range
+        self._slope_str = repr(self._slope)
+        self._min_str = str(self.min)
+        self._max_str = str(self.max)
+        self._size_str = str(self.size)
+
+    @classmethod
+    def get_or_create(
+            cls,
+            params: Any,
+            signals: _SignalTable,
+    ) -> 'CANSignal':
+        """Load from YAML, reusing an identical signal from `signals`.
+
+        Signals are never modified after loading, so fields with the
+        same parameters can share one instance. Parameters are compared
+        by their repr, so that e.g. `0` and `0.0` stay distinct and
+        keep their own text forms in the output.
+
+        """
+        key = repr((
+            params.get('unit', ''),
+            params['range'][0],
+            params['range'][1],
+            params.get('size', 8),
+        ))
+        signal = signals.get(key)
+        if signal is None:
+            signal = cls(params)
+            signals[key] = signal
+        return signal
 
-    def serialize_kcd(
+    def slope(self) -> float:
+        """Slope of the linear equation."""
+        return self._slope
+
+    def serialize_kcd_text(
             self,
-            serializer: KCDMessageSerializer,
+            out: TextIO,
+            indent: int,
+            bit_pos: int,
             name: str,
-    ) -> None:
-        """Serialize to a KCD file."""
-        serializer.write(
-            XML(
-                'Signal',
-                {
-                    'name': name,
-                    'offset': str(serializer.bit_pos),
-                    'length': str(self.size),
-                },
-                [XML(
-                    'Value',
-                    {
-                        'type': 'unsigned',
-                        'unit': self.unit,
-                        'slope': str(self.slope()),
-                        'intercept': str(self.min),
-                        'min': str(self.min),
-                        'max': str(self.max),
-                    },
-                )],
-            ),
-            self.size,
+    ) -> int:
+        """Serialize to KCD text, returning the new bit position."""
+        pad = ' ' * indent
+        out.write(
+            f'{pad}<Signal name="{name}" offset="{_bit_pos_str(bit_pos)}" '
+            f'length="{self._size_str}">\n'
+            f'{pad}  <Value type="unsigned" unit="{self.unit}" '
+            f'slope="{self._slope_str}" intercept="{self._min_str}" '
+            f'min="{self._min_str}" max="{self._max_str}">\n'
+            f'{pad}  </Value>\n'
+            f'{pad}</Signal>\n'
         )
+        return bit_pos + self.size
 
 
 class CANStruct:
@@ -78,38 +111,53 @@ class CANStruct:
 
     """
 
-    def __init__(self, name: str, yaml: Any) -> None:
-        """Load from YAML."""
+    def __init__(
+            self,
+            name: str,
+            yaml: Any,
+            signals: Optional[_SignalTable] = None,
+    ) -> None:
+        """Load from YAML.
+
+        Pass the same `signals` table when loading every struct in a
+        database to share identical signals between them.
+
+        """
+        if signals is None:
+            signals = {}
         self.name = name
+        self._deps_cache: Optional[List[str]] = None
+        self._layout: Optional[List[_LayoutEntry]] = None
+        self._layout_reversed: Optional[List[_LayoutEntry]] = None
 
         if isinstance(yaml, list):
             # Struct.
             self.is_enum = False
-            self.struct_members: List[Tuple[str, Union[CANSignal, str]]] = (
-                list(map(
-                    lambda member: (
-                        list(member.keys())[0],
-                        CANStruct._member_type_to_signal(
-                            list(member.values())[0]
-                        ),
-                    ),
-                    yaml,
-                ))
-            )
+            self.struct_members: List[Tuple[str, Union[CANSignal, str]]] = []
+            for member in yaml:
+                field, typ = next(iter(member.items()))
+                self.struct_members.append(
+                    (field, CANStruct._member_type_to_signal(typ, signals))
+                )
         elif isinstance(yaml, dict):
             # Enum.
-            if list(yaml.keys()) != ['enum']:
+            if len(yaml) != 1 or 'enum' not in yaml:
                 raise CANSemanticException(f'Invalid struct def: {yaml}')
             self.is_enum = True
             self.enum_members: List[str] = yaml['enum']
+            if not self.enum_members:
+                raise CANSemanticException(f'Empty enum: {name}')
 
     @staticmethod
-    def _member_type_to_signal(yaml: Any) -> Union[CANSignal, str]:
+    def _member_type_to_signal(
+            yaml: Any,
+            signals: _SignalTable,
+    ) -> Union[CANSignal, str]:
         """Convert a yaml type to a CANSignal or struct name."""
         if isinstance(yaml, str):
             return yaml
         else:
-            return CANSignal(yaml)
+            return CANSignal.get_or_create(yaml, signals)
 
     def dependencies(self) -> List[str]:
         """List the dependencies on other structures.
@@ -117,30 +165,73 @@ class CANStruct:
         This method filters out the built-in structure `bool`.
 
         """
-        built_in = ['bool']
-
-        if self.is_enum:
-            return []
-        else:
-            deps: List[str] = []
-            for name, member in self.struct_members:
-                if isinstance(member, str) and member not in built_in:
-                    deps.append(member)
-            return deps
+        if self._deps_cache is None:
+            if self.is_enum:
+                self._deps_cache = []
+            else:
+                self._deps_cache = [
+                    member for _, member in self.struct_members
+                    if isinstance(member, str)
+                    and member not in _BUILT_IN_TYPES
+                ]
+        return self._deps_cache
+
+    def size(self, sizes: Dict[str, int]) -> int:
+        """Size of the struct, in bits.
+
+        `sizes` must already hold the size of every dependency; see
+        `_struct_sizes()`.
 
-    def size(self, struct_defs: Dict[str, 'CANStruct']) -> int:
-        """Size of the struct, in bits."""
+        """
         if self.is_enum:
-            return math.ceil(math.log2(len(self.enum_members)))
+            # Exact ceil(log2(n)) for integers, with no float rounding.
+            return (len(self.enum_members) - 1).bit_length()
         else:
             total = 0
             for name, member in self.struct_members:
                 if isinstance(member, CANSignal):
                     total += member.size
                 else:
-                    total += struct_defs[member].size(struct_defs)
+                    total += sizes[member]
             return total
 
+    def _flatten_layout(
+            self,
+            struct_defs: Dict[str, 'CANStruct'],
+            sizes: Dict[str, int],
+    ) -> List[_LayoutEntry]:
+        """Get the wire layout of the struct's direct members.
+
+        This is computed once and shared by the KCD and C++ backends,
+        so neither has to re-derive member kinds and sizes.
+
+        """
+        if self._layout is None:
+            layout: List[_LayoutEntry] = []
+            for name, typ in self.struct_members:
+                if isinstance(typ, CANSignal):
+                    layout.append((name, typ.size, 'signal', typ))
+                elif typ == 'bool':
+                    layout.append((name, sizes[typ], 'bool', typ))
+                else:
+                    struct = struct_defs[typ]
+                    kind = 'enum' if struct.is_enum else 'nested'
+                    layout.append((name, sizes[typ], kind, typ))
+            self._layout = layout
+        return self._layout
+
+    def _reversed_layout(
+            self,
+            struct_defs: Dict[str, 'CANStruct'],
+            sizes: Dict[str, int],
+    ) -> List[_LayoutEntry]:
+        """Get the wire layout in reverse, as the serializer packs it."""
+        if self._layout_reversed is None:
+            self._layout_reversed = (
+                self._flatten_layout(struct_defs, sizes)[::-1]
+            )
+        return self._layout_reversed
+
     def __repr__(self) -> str:
         """Get string representation."""
         if self.is_enum:
@@ -148,88 +239,92 @@ class CANStruct:
         else:
             return f'<CAN struct {self.struct_members}>'
 
-    def serialize_members_kcd(
+    def serialize_members_kcd_text(
             self,
-            serializer: KCDMessageSerializer,
+            out: TextIO,
+            indent: int,
+            bit_pos: int,
             struct_defs: Dict[str, 'CANStruct'],
+            sizes: Dict[str, int],
             name_base: str = '',
-    ) -> None:
-        """Serialize members to a KCD file."""
+    ) -> int:
+        """Serialize members to KCD text, returning the new bit position."""
+        pad = ' ' * indent
         if self.is_enum:
-            serializer.write(
-                XML(
-                    'Signal',
-                    {
-                        'name': name_base.rstrip('_'),
-                        'offset': str(serializer.bit_pos),
-                        'length': str(self.size({})),
-                    },
-                    [XML(
-                        'LabelSet',
-                        children=list(map(
-                            lambda member: XML(
-                                'Label',
-                                {
-                                    'name': member[1],
-                                    'value': str(member[0]),
-                                }
-                            ),
-                            enumerate(self.enum_members),
-                        ))
-                    )],
-                ),
-                self.size({})
+            size = sizes[self.name]
+            out.write(
+                f'{pad}<Signal name="{name_base.rstrip("_")}" '
+                f'offset="{_bit_pos_str(bit_pos)}" length="{size}">\n'
+                f'{pad}  <LabelSet>\n'
             )
-        else:
-            for member in self.struct_members:
-                if isinstance(member[1], CANSignal):
-                    member[1].serialize_kcd(serializer, name_base + member[0])
-                elif member[1] == 'bool':
-                    serializer.write(
-                        XML(
-                            'Signal',
-                            {
-                                'name': name_base + member[0],
-                                'offset': str(serializer.bit_pos),
-                                'length': '1',
-                            },
-                            [XML(
-                                'Value',
-                                {
-                                    'type': 'unsigned',
-                                },
-                            )]
-                        ),
-                        1,
-                    )
-                else:
-                    struct_defs[member[1]].serialize_members_kcd(
-                        serializer,
-                        struct_defs,
-                        name_base + member[0] + '_'
-                    )
-
-    def serialize_message_kcd(
+            for idx, member in enumerate(self.enum_members):
+                out.write(
+                    f'{pad}    <Label name="{member}" value="{idx}">\n'
+                    f'{pad}    </Label>\n'
+                )
+            out.write(
+                f'{pad}  </LabelSet>\n'
+                f'{pad}</Signal>\n'
+            )
+            return bit_pos + size
+
+        for name, size, kind, typ in self._flatten_layout(struct_defs, sizes):
+            if kind == 'signal':
+                assert isinstance(typ, CANSignal)
+                bit_pos = typ.serialize_kcd_text(
+                    out,
+                    indent,
+                    bit_pos,
+                    name_base + name,
+                )
+            elif kind == 'bool':
+                out.write(
+                    f'{pad}<Signal name="{name_base + name}" '
+                    f'offset="{_bit_pos_str(bit_pos)}" length="1">\n'
+                    f'{pad}  <Value type="unsigned">\n'
+                    f'{pad}  </Value>\n'
+                    f'{pad}</Signal>\n'
+                )
+                bit_pos += size
+            else:
+                # Nested structs and enums alike; an enum strips the
+                # trailing underscore back off its name.
+                assert isinstance(typ, str)
+                bit_pos = struct_defs[typ].serialize_members_kcd_text(
+                    out,
+                    indent,
+                    bit_pos,
+                    struct_defs,
+                    sizes,
+                    name_base + name + '_'
+                )
+        return bit_pos
+
+    def serialize_message_kcd_text(
             self,
+            out: TextIO,
+            indent: int,
             struct_defs: Dict[str, 'CANStruct'],
+            sizes: Dict[str, int],
             id: int,
-    ) -> XML:
-        """Serialize to a KCD file as a message."""
-        serializer = KCDMessageSerializer()
-        self.serialize_members_kcd(serializer, struct_defs)
-        return XML(
-            'Message',
-            {
-                'id': str(id),
-                'name': self.name,
-            },
-            serializer.contents,
+    ) -> None:
+        """Serialize to KCD text as a message."""
+        pad = ' ' * indent
+        out.write(f'{pad}<Message id="{id}" name="{self.name}">\n')
+        self.serialize_members_kcd_text(
+            out,
+            indent + 2,
+            0,
+            struct_defs,
+            sizes,
         )
+        out.write(f'{pad}</Message>\n')
 
     def serialize_cpp(
             self,
             output: Callable[[str], None],
             struct_defs: Dict[str, 'CANStruct'],
+            sizes: Dict[str, int],
     ) -> None:
         """Serialize to a C++ header."""
         if self.is_enum:
@@ -281,17 +376,15 @@ class CANStruct:
             output(f'inline {self.name} {self.name}_deserialize(' +
                    'uint64_t buffer) {')
             output(f'  {self.name} self;')
-            for name, typ in self.struct_members:
-                if isinstance(typ, CANSignal):
+            layout = self._flatten_layout(struct_defs, sizes)
+            for name, size, kind, typ in layout:
+                if kind == 'signal':
+                    assert isinstance(typ, CANSignal)
                     output(
-                        f'  self.{name} = (double)read(buffer, {typ.size})' +
-                        f' * {typ.slope()} + {typ.min};'
+                        f'  self.{name} = (double)read(buffer, {size})' +
+                        f' * {typ._slope_str} + {typ._min_str};'
                     )
                 else:
-                    if typ == 'bool':
-                        size = 1
-                    else:
-                        size = struct_defs[typ].size(struct_defs)
                     output(
                         f'  self.{name} = {typ}_deserialize(' +
                         f'read(buffer, {size}));'
@@ -302,17 +395,17 @@ class CANStruct:
             output('')
             output(f'inline uint64_t serialize({self.name} data) {{')
             output('  uint64_t ser = 0;')
-            for name, typ in reversed(self.struct_members):
-                if isinstance(typ, CANSignal):
-                    value = f'(data.{name} - {typ.min}) / {typ.slope()}'
+            reversed_layout = self._reversed_layout(struct_defs, sizes)
+            for name, size, kind, typ in reversed_layout:
+                if kind == 'signal':
+                    assert isinstance(typ, CANSignal)
+                    value = (
+                        f'(data.{name} - {typ._min_str}) / {typ._slope_str}'
+                    )
                     output(
-                        f'  write(ser, {typ.size}, {value});'
+                        f'  write(ser, {size}, {value});'
                     )
                 else:
-                    if typ == 'bool':
-                        size = 1
-                    else:
-                        size = struct_defs[typ].size(struct_defs)
                     output(
                         f'  write(ser, {size}, serialize(data.{name}));'
                     )
@@ -330,74 +423,99 @@ class CANStruct:
             output('}')
 
 
-def database_to_kcd(database: Any) -> XML:
-    """Convert a database YAML file to a KCD file."""
+def _build_struct_defs(
+        database: Any,
+) -> Tuple[Dict[str, CANStruct], List[str]]:
+    """Load every struct and message definition from a database.
+
+    Returns the definitions by name, along with the message names in
+    declaration order; a message's index in that list is its CAN ID.
+
+    """
+    signals: _SignalTable = {}
     struct_defs: Dict[str, CANStruct] = {}
-    for struct_name in database['structs'].keys():
-        struct_defs[struct_name] = CANStruct(
-            struct_name,
-            database['structs'][struct_name]
-        )
-    for struct_name in database['messages'].keys():
-        struct_defs[struct_name] = CANStruct(
-            struct_name,
-            database['messages'][struct_name]
-        )
+    for struct_name, yaml in database['structs'].items():
+        struct_defs[struct_name] = CANStruct(struct_name, yaml, signals)
 
-    messages: List[XML] = []
-    for id, struct_name in enumerate(database['messages'].keys()):
-        messages.append(struct_defs[struct_name].serialize_message_kcd(
-            struct_defs,
-            id,
-        ))
+    message_names: List[str] = []
+    for struct_name, yaml in database['messages'].items():
+        struct_defs[struct_name] = CANStruct(struct_name, yaml, signals)
+        message_names.append(struct_name)
 
-    return XML(
-        'NetworkDefinition',
-        {
-            'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance',
-            # yes, it's a dead link.
-            'xmlns': 'http://kayak.2codeornot2code.org/1.0',
-            'xsi:noNamespaceSchemaLocation': 'Definition.xsd',
-        },
-        [
-            XML(
-                'Document',
-                {
-                    'name': database['name'],
-                    'version': '1.0',
-                    'author': 'autogenerated',
-                    'date': '1970-01-01',
-                },
-                content='Autogenerated from canspec.'
-            ),
-            XML(
-                'Bus',
-                {'name': 'Main'},
-                messages,
-            ),
-        ],
+    return struct_defs, message_names
+
+
+def _struct_order(struct_defs: Dict[str, CANStruct]) -> List[str]:
+    """Order struct names so each comes after everything it contains."""
+    return _topological_sort(
+        struct_defs.keys(),
+        lambda name: struct_defs[name].dependencies(),
     )
 
 
-def database_to_cpp(database: Any) -> str:
-    """Convert a database YAML file to a C++ header file."""
-    struct_defs: Dict[str, CANStruct] = {}
-    for struct_name in database['structs'].keys():
-        struct_defs[struct_name] = CANStruct(
-            struct_name,
-            database['structs'][struct_name]
-        )
-    for struct_name in database['messages'].keys():
-        struct_defs[struct_name] = CANStruct(
-            struct_name,
-            database['messages'][struct_name]
+def _struct_sizes(
+        struct_defs: Dict[str, CANStruct],
+        struct_order: List[str],
+) -> Dict[str, int]:
+    """Compute the size in bits of every struct, including `bool`.
+
+    `struct_order` must be dependency-first, as from `_struct_order()`,
+    so each struct's members are always sized before the struct
+    itself.
+
+    """
+    sizes = dict(_BUILT_IN_SIZES)
+    for struct_name in struct_order:
+        if struct_name not in _BUILT_IN_TYPES:
+            sizes[struct_name] = struct_defs[struct_name].size(sizes)
+    return sizes
+
+
+def database_to_kcd(database: Any, out: TextIO, indent: int = 0) -> None:
+    """Convert a database YAML file to a KCD file, writing it to `out`.
+
+    The KCD layout is fixed, so this writes the text directly rather
+    than building an XML tree first.
+
+    """
+    struct_defs, message_names = _build_struct_defs(database)
+    sizes = _struct_sizes(struct_defs, _struct_order(struct_defs))
+
+    pad = ' ' * indent
+    out.write(
+        f'{pad}<NetworkDefinition'
+        ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+        # yes, it's a dead link.
+        ' xmlns="http://kayak.2codeornot2code.org/1.0"'
+        ' xsi:noNamespaceSchemaLocation="Definition.xsd">\n'
+        f'{pad}  <Document name="{database["name"]}" version="1.0"'
+        ' author="autogenerated" date="1970-01-01">\n'
+        f'{pad}    Autogenerated from canspec.\n'
+        f'{pad}  </Document>\n'
+        f'{pad}  <Bus name="Main">\n'
+    )
+
+    for id, struct_name in enumerate(message_names):
+        struct_defs[struct_name].serialize_message_kcd_text(
+            out,
+            indent + 4,
+            struct_defs,
+            sizes,
+            id,
         )
 
-    out = ''
+    out.write(
+        f'{pad}  </Bus>\n'
+        f'{pad}</NetworkDefinition>\n'
+    )
+
+
+def database_to_cpp(database: Any, out: TextIO) -> None:
+    """Convert a database YAML file to a C++ header, writing it to `out`."""
+    struct_defs, message_names = _build_struct_defs(database)
 
     def putline(line: str, end: str = '\n') -> None:
-        nonlocal out
-        out += line + '\n'
+        out.write(line + '\n')
 
     putline('// Structures and conversions generated by can.py.')
     putline(f'#ifndef {database["name"]}_H')
@@ -409,14 +527,29 @@ def database_to_cpp(database: Any) -> str:
     # needed for formatted output
     putline('#include <ostream>')
 
+    # needed for _bzhi_u64, where the target has it
+    putline('#ifdef __BMI2__')
+    putline('#include <immintrin.h>')
+    putline('#endif')
+
     # Be polite and put everything in a namespace ;3
     putline('namespace can {')
 
     # We'll use this function for getting individual bits off of a
     # 64-bit buffer.
     putline('')
+    # Shifting a 64-bit value by 64 is undefined behavior in C++, so
+    # full-width reads and writes are special-cased.
     putline('inline uint64_t read(uint64_t &buffer, uint8_t bits) {')
-    putline('  uint64_t res = buffer & ((1 << bits) - 1);')
+    putline('  if (bits >= 64) {')
+    putline('    uint64_t res = buffer;')
+    putline('    return buffer = 0, res;')
+    putline('  }')
+    putline('#ifdef __BMI2__')
+    putline('  uint64_t res = _bzhi_u64(buffer, bits);')
+    putline('#else')
+    putline('  uint64_t res = buffer & ((1ULL << bits) - 1ULL);')
+    putline('#endif')
     putline('  return buffer >>= bits, res;')
     putline('}')
 
@@ -424,7 +557,7 @@ def database_to_cpp(database: Any) -> str:
     putline('')
     putline('inline void write(uint64_t &buffer, uint8_t bits, '
             'uint64_t data) {')
-    putline('  buffer <<= bits;')
+    putline('  buffer = bits >= 64 ? 0 : buffer << bits;')
     putline('  buffer |= data;')
     # putline('  buffer >>= bits;')
     # putline('  buffer |= data << (64 - bits);')
@@ -442,7 +575,7 @@ def database_to_cpp(database: Any) -> str:
 
     putline('')
     putline('enum class FrameID {')
-    for index, name in enumerate(database['messages'].keys()):
+    for index, name in enumerate(message_names):
         putline(f'  {name} = {index},')
     putline('};')
 
@@ -455,23 +588,19 @@ def database_to_cpp(database: Any) -> str:
     # C++ doesn't let us put structs that haven't been defined yet
     # inside other structs; therefore, we have no choice but to use a
     # topological sort to figure out the order to declare them.
-    struct_order = _topological_sort(
-        struct_defs.keys(),
-        lambda name: struct_defs[name].dependencies(),
-    )
+    struct_order = _struct_order(struct_defs)
+    sizes = _struct_sizes(struct_defs, struct_order)
 
     for struct_name in struct_order:
         # Hack
         if struct_name == 'bool':
             continue
 
-        struct_defs[struct_name].serialize_cpp(putline, struct_defs)
+        struct_defs[struct_name].serialize_cpp(putline, struct_defs, sizes)
 
     putline(f'}} // namespace can_{database["name"]}')
     putline(f'#endif // {database["name"]}_H')
 
-    return out
-
 
 T = TypeVar('T')
 
@@ -488,17 +617,39 @@ def _topological_sort(
     nodes N and M, if a path N -> ... -> M exists, then M precedes N
     in the list.
 
+    Raises `CANSemanticException` if the graph has a cycle.
+
     """
     result: List[T] = []
+    visited: Set[T] = set()
 
-    def explore(node: T) -> None:
-        nonlocal result, nodes, edges
-        if node not in result:
-            for edge in edges(node):
-                explore(edge)
-            result.append(node)
+    finished: Set[T] = set()
 
+    # Iterative post-order DFS, so deep hierarchies can't run into
+    # Python's recursion limit. Each stack entry is a node and whether
+    # its children have already been pushed; the expanded entries
+    # still on the stack are the path currently being explored.
+    stack: List[Tuple[T, bool]] = []
     for node in nodes:
-        explore(node)
+        stack.append((node, False))
+        while stack:
+            current, expanded = stack.pop()
+            if expanded:
+                result.append(current)
+                finished.add(current)
+            elif current in visited:
+                if current not in finished:
+                    path = [entry for entry, on_path in stack if on_path]
+                    cycle = path[path.index(current):] + [current]
+                    raise CANSemanticException(
+                        'Cyclic dependency: ' +
+                        ' -> '.join(str(entry) for entry in cycle)
+                    )
+            else:
+                visited.add(current)
+                stack.append((current, True))
+                # Push in reverse so children are explored in order.
+                for edge in reversed(list(edges(current))):
+                    stack.append((edge, False))
 
     return result
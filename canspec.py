@@ -36,15 +36,18 @@ def _main() -> None:
         exit(-1)
 
     with open(parsed[infile]) as file:
-        input = yaml.load(file.read(), Loader=yaml.UnsafeLoader)
+        # Prefer the LibYAML-backed loader when it's available; it's
+        # much faster and can parse straight from the file.
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        input = yaml.load(file, Loader=loader)
 
     if parsed[kcd]:
         with open(parsed[kcd], 'w') as file:
-            file.write(str(_convert.database_to_kcd(input).human_readable(2)))
+            _convert.database_to_kcd(input, file, 2)
 
     if parsed[hpp]:
         with open(parsed[hpp], 'w') as file:
-            file.write(_convert.database_to_cpp(input))
+            _convert.database_to_cpp(input, file)
 
 
 if __name__ == '__main__':